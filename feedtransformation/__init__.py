@@ -1,10 +1,13 @@
 from .src.feedtransformation import (
     rename_cols,
     format_cols,
+    filter_products,
     create_metadata,
     all_combinations_metadata,
     group_metadata,
     rename_column_value,
+    rename_column_values,
     export_csv,
     export_json,
+    collect,
 )
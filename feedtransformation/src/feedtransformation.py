@@ -1,10 +1,14 @@
 import polars as pl
 from typing import List, Union
-from polars import ColumnNotFoundError
+from polars.exceptions import ColumnNotFoundError
+from functools import lru_cache
+import sys
 import warnings
 
+FeedFrame = Union[pl.DataFrame, pl.LazyFrame]
 
-def rename_cols(feed: pl.DataFrame, **kwargs) -> pl.DataFrame:
+
+def rename_cols(feed: FeedFrame, **kwargs) -> FeedFrame:
     """
     Rename columns of the feed
 
@@ -20,7 +24,7 @@ def rename_cols(feed: pl.DataFrame, **kwargs) -> pl.DataFrame:
     return feed.rename(kwargs)
 
 
-def format_cols(feed: pl.DataFrame) -> pl.DataFrame:
+def format_cols(feed: FeedFrame) -> FeedFrame:
     """
     Format columns of the feed
 
@@ -30,20 +34,44 @@ def format_cols(feed: pl.DataFrame) -> pl.DataFrame:
     Returns:
         self
     """
-    return feed.select(
-        pl.all().map_alias(lambda col: col.strip().lower().replace(" ", "_"))
-    )
+    rename_dict = {}
+    for col in _schema(feed).names():
+        formatted = _format_col_name(col)
+        if formatted != col:
+            rename_dict[col] = formatted
+
+    return feed.rename(rename_dict)
+
+
+def filter_products(feed: FeedFrame, col: str, values: list) -> FeedFrame:
+    """
+    Keep only the rows whose value in column col is one of values
+
+    Call it before create_metadata/all_combinations_metadata so that, on a lazy
+    feed, the filter is pushed down below the metadata struct construction.
+
+    Parameters:
+        col (str): The name of the column
+        values (list): The values to keep (the keys are used if a dict is given)
+
+    Returns:
+        self
+    """
+    _validate_existing_columns(feed, col)
+
+    return feed.filter(pl.col(col).is_in(list(values)))
 
 
 def create_metadata(
-    feed: pl.DataFrame, cols: list, meta_name: str = "metadata", exclude: str = None
-) -> pl.DataFrame:
+    feed: FeedFrame, cols: list, meta_name: str = "metadata", exclude: str = None
+) -> FeedFrame:
     """
     Create metadata column as a struct of the columns in cols
 
     Parameters:
         cols (list): A list of columns to be included in the metadata column
         meta_name (str): The name of the metadata column
+        exclude (str or list): Column name(s) or regex pattern(s) to drop from the feed
 
     Returns:
         self
@@ -55,60 +83,109 @@ def create_metadata(
     feed = feed.with_columns(pl.struct(cols).alias(meta_name))
 
     if exclude:
+        # On a lazy feed the optimizer fuses this with the with_columns above
         feed = feed.select(pl.exclude(exclude))
 
     return feed
 
 
 def all_combinations_metadata(
-    feed: pl.DataFrame, col: str, over_col: Union[str, List[str]]
-) -> pl.DataFrame:
+    feed: FeedFrame,
+    col: Union[List[str], str],
+    over_col: Union[str, List[str]],
+    meta_name: str = "metadata",
+) -> FeedFrame:
     """
-    Create metadata column as a struct of the columns in cols for all combinations of on_col
+    Replace column col with the list of its values for all combinations of over_col
+
+    The list is computed with a single window expression (mapping_strategy="join"),
+    so no intermediate group_by or join is needed.
 
     Parameters:
-        col (list): A list of columns to be included in the metadata column
-        on_col (str or list): The column(s) to group by
-        col_name (str): The name of the metadata column
+        col (str or list): The column (usually a metadata struct) to collect, or a
+            list of columns to build the metadata struct from inside the window
+        over_col (str or list): The column(s) to group by
+        meta_name (str): The name of the metadata column when col is a list
 
     Returns:
         self
     """
     _validate_existing_columns(feed, col)
 
-    return feed.with_columns(pl.col(col).over(over_col, mapping_strategy="join"))
+    if isinstance(col, list):
+        _overwrite_metadata(feed, meta_name)
+        expr = pl.struct(col).alias(meta_name)
+    else:
+        expr = pl.col(col)
+
+    return feed.with_columns(expr.over(over_col, mapping_strategy="join"))
 
 
 def group_metadata(
-    feed: pl.DataFrame,
+    feed: FeedFrame,
     group_cols: Union[List[str], str],
-    metadata: str = "metadata",
+    metadata: Union[List[str], str] = "metadata",
     order: bool = False,
-) -> pl.DataFrame:
+    meta_name: str = "metadata",
+    categorical_keys: bool = False,
+) -> FeedFrame:
     """
     Group metadata column by group_cols and keep the first value of the other columns
 
     Parameters:
         group_cols (list or str): A list of columns to group by (or a single column name)
-        order (bool): Whether to maintain the order of the feed
+        metadata (str or list): The metadata column, or a list of columns to build
+            the metadata struct from inside the aggregation (skips create_metadata)
+        order (bool): Whether to maintain the order of the feed. Setting order=True
+            disables partitioned hash aggregation (see Polars issue #20346); if a
+            stable output is needed, prefer sorting the result once by group_cols
+        meta_name (str): The name of the metadata column when metadata is a list
+        categorical_keys (bool): Whether to hash string group columns as Categorical
+            (they are cast back to strings in the result). The cast itself hashes
+            every string, so this only pays off for low-cardinality keys
 
     Returns:
         self
     """
-    try:
-        feed.select(pl.col(group_cols))
-    except ColumnNotFoundError:
-        raise ColumnNotFoundError("One or more columns in cols not found in feed")
+    _validate_existing_columns(feed, group_cols)
 
-    cols = [col for col in feed.columns if col not in group_cols and col != metadata]
-    return feed.group_by(group_cols, maintain_order=order).agg(
-        pl.col(cols).first(), pl.col(metadata)
-    )
+    if isinstance(metadata, list):
+        _validate_existing_columns(feed, metadata)
+        _overwrite_metadata(feed, meta_name)
+        meta_expr = pl.struct(metadata).alias(meta_name)
+    else:
+        meta_name = metadata
+        meta_expr = pl.col(metadata)
+
+    group_cols_set = {group_cols} if isinstance(group_cols, str) else set(group_cols)
+    schema = _schema(feed)
+    all_cols = schema.names()
+    cols = [
+        col for col in all_cols if col not in group_cols_set and col != meta_name
+    ]
+
+    string_keys = []
+    keys = group_cols
+    if categorical_keys:
+        string_keys = [col for col in group_cols_set if schema[col] == pl.String]
+        # Cast only the keys, so the aggregations still read the String columns
+        keys = [
+            pl.col(col).cast(pl.Categorical) if col in string_keys else pl.col(col)
+            for col in ([group_cols] if isinstance(group_cols, str) else group_cols)
+        ]
+
+    aggs = [pl.col(col).first() for col in cols] + [meta_expr]
+    feed = feed.group_by(keys, maintain_order=order).agg(*aggs)
+
+    if string_keys:
+        feed = feed.with_columns(pl.col(string_keys).cast(pl.String))
+
+    return feed
 
 
 def rename_column_value(
-    feed: pl.DataFrame, col: str, old: str, new: str, regex=False, ow: str = None
-) -> pl.DataFrame:
+    feed: FeedFrame, col: str, old: str, new: str, regex=False, ow: str = None
+) -> FeedFrame:
     """
     Rename column value from old to new in column col
 
@@ -117,19 +194,18 @@ def rename_column_value(
         old (str): The old value
         new (str): The new value
         regex (bool): Whether to use regex
-        ow (str): The value to replace with if old is not found
+        ow (str): The value to replace with if old is not found. If not specified,
+            values other than old are kept (previously they were set to old)
 
     Returns:
         self
     """
     _validate_existing_columns(feed, col)
 
-    if ow is None:
-        ow = old
-        warnings.warn(f"ow not specified. Using old value {old} as ow")
-
     if regex:
-        feed = feed.with_columns(pl.col(col).str.replace(rf"{old}", new))
+        feed = feed.with_columns(pl.col(col).str.replace(old, new))
+    elif ow is None:
+        feed = feed.with_columns(pl.col(col).replace({old: new}))
     else:
         feed = feed.with_columns(
             pl.when(pl.col(col) == old)
@@ -140,19 +216,54 @@ def rename_column_value(
     return feed
 
 
+def rename_column_values(
+    feed: FeedFrame, col: str, mapping: dict, regex=False, ow: str = None
+) -> FeedFrame:
+    """
+    Rename several values of column col in a single expression
+
+    Parameters:
+        col (str): The name of the column
+        mapping (dict): A dictionary of old values (or patterns) to new values
+        regex (bool): Whether the keys of mapping are regex patterns
+        ow (str): The value to replace with if no old value is found
+            (ignored when regex is True; by default the value is kept)
+
+    Returns:
+        self
+    """
+    _validate_existing_columns(feed, col)
+
+    if regex:
+        expr = pl.col(col)
+        for old, new in mapping.items():
+            expr = expr.str.replace(old, new)
+    elif ow is None:
+        expr = pl.col(col).replace(mapping)
+    else:
+        expr = pl.col(col).replace_strict(mapping, default=pl.lit(ow))
+
+    return feed.with_columns(expr.alias(col))
+
+
 def export_json(
-    feed: pl.DataFrame, path: str, finalize: bool = True
-) -> pl.DataFrame | None:
+    feed: FeedFrame, path: str, finalize: bool = True, streaming: bool = True
+) -> FeedFrame | None:
     """
     Export feed to json
 
     Parameters:
         path (str): The path to export the feed
         finalize (bool): Whether to finalize the feed (i.e. return None)
+        streaming (bool): Whether to stream the feed as newline-delimited json.
+            If False, the feed is collected and written as a single json array
     Returns:
         self
     """
-    feed.write_json(path, row_oriented=True, pretty=True)
+    if streaming:
+        feed.lazy().sink_ndjson(path, engine="streaming")
+    else:
+        collect(feed, streaming=False).write_json(path)
 
     if finalize:
         return None
@@ -161,39 +272,77 @@ def export_json(
 
 
 def export_csv(
-    feed: pl.DataFrame, path: str, finalize: bool = False
-) -> pl.DataFrame | None:
+    feed: FeedFrame, path: str, finalize: bool = False, streaming: bool = True
+) -> FeedFrame | None:
     """
     Export feed to csv
 
     Parameters:
         path (str): The path to export the feed
         finalize (bool): Whether to finalize the feed (i.e. return None)
+        streaming (bool): Whether to stream the feed to the file in batches
 
     Returns:
         self
     """
-    feed.write_csv(path)
+    if streaming:
+        feed.lazy().sink_csv(path, engine="streaming")
+    else:
+        collect(feed, streaming=False).write_csv(path)
     if finalize:
         return None
     return feed
 
 
-def _validate_existing_columns(df: pl.DataFrame, cols: list[str] | str) -> None:
+def collect(
+    feed: FeedFrame, streaming: bool = True, chunk_size: int = None
+) -> pl.DataFrame:
+    """
+    Execute the transformations of a lazy feed
+
+    Parameters:
+        streaming (bool): Whether to run the query on the streaming engine
+        chunk_size (int): The streaming chunk size, only set for this collect
+
+    Returns:
+        pl.DataFrame
+    """
+    if isinstance(feed, pl.DataFrame):
+        return feed
+
+    if not streaming:
+        return feed.collect()
+
+    if chunk_size is None:
+        return feed.collect(engine="streaming")
+
+    with pl.Config(streaming_chunk_size=chunk_size):
+        return feed.collect(engine="streaming")
+
+
+def _schema(df: FeedFrame) -> pl.Schema:
+    return df.collect_schema() if isinstance(df, pl.LazyFrame) else df.schema
+
+
+def _validate_existing_columns(df: FeedFrame, cols: list[str] | str) -> None:
+    missing = set(cols if isinstance(cols, list) else [cols]) - set(
+        _schema(df).names()
+    )
+    if not missing:
+        return
+
     if isinstance(cols, list):
-        try:
-            df.select(pl.col(cols))
-        except ColumnNotFoundError:
-            raise ColumnNotFoundError("One or more columns in cols not found in feed.")
-    else:
-        try:
-            df.select(pl.col(cols))
-        except ColumnNotFoundError:
-            raise ColumnNotFoundError(f"Column {cols} not found in feed")
+        raise ColumnNotFoundError("One or more columns in cols not found in feed.")
+    raise ColumnNotFoundError(f"Column {cols} not found in feed")
+
+
+@lru_cache(maxsize=1024)
+def _format_col_name(col: str) -> str:
+    return sys.intern(col.strip().lower().replace(" ", "_"))
 
 
-def _overwrite_metadata(df: pl.DataFrame, metadata: str) -> None:
-    if metadata in df.columns:
+def _overwrite_metadata(df: FeedFrame, metadata: str) -> None:
+    if metadata in _schema(df):
         warnings.warn(
             f"Column {metadata} already exists in feed. It will be overwritten"
         )
@@ -7,5 +7,5 @@ setup(
     author="José Carlos Borrayo Tojín",
     author_email="thecircuitproject1@gmail.com",
     packages=find_packages(),
-    install_requires=["polars>=0.20.14"],
+    install_requires=["polars>=1.25"],
 )